@@ -9,7 +9,6 @@ Type "powerspec.py -h" to see command line requirements and options.
 from __future__ import print_function
 import argparse
 import numpy as np
-import scipy.fftpack as fftpack
 from astropy.io import fits
 from datetime import datetime
 from astropy.table import Table, Column
@@ -18,11 +17,25 @@ import psd_lightcurves as psd_lc
 __author__ = "Abigail Stevens <A.L.Stevens at uva.nl>"
 __year__ = "2013-2016"
 
+## Use the fastest real-input FFT available. scipy.fft can split the FFTs of
+## many segments over all CPU cores; numpy.fft is the same pocketfft code, but
+## single-threaded. (scipy.fftpack is older and slower than either.)
+try:
+    from scipy.fft import rfft, rfftfreq
+    FFT_KWARGS = {'workers': -1}
+except ImportError:
+    from numpy.fft import rfft, rfftfreq
+    FFT_KWARGS = {}
+
+## Approximate number of bytes of complex FFT output to compute at once when
+## many segments are done together; about the size of a CPU's L2/L3 cache
+FFT_BLOCK_BYTES = 4 * 1024 * 1024
+
 
 ################################################################################
 def power_of_two(num):
     """
-	Check if a positive integer is a power of 2 (1 <= num < 2147483648).
+	Check if a positive integer is a power of 2.
 
 	Parameters
 	----------
@@ -40,15 +53,11 @@ def power_of_two(num):
 
     """
     n = int(num)
-    x = 2
     assert n > 0, "ERROR: Number must be positive."
 
-    if n == 1:
-        return True
-    else:
-        while x < n and x < 2147483648:
-            x *= 2
-        return n == x
+    ## A power of two has exactly one bit set, and n-1 has all of the bits
+    ## below it set, so they share no bits
+    return (n & (n - 1)) == 0
 
 
 ################################################################################
@@ -87,8 +96,7 @@ def type_positive_int(num):
 ################################################################################
 def type_power_of_two(num):
     """
-	Check if an input is a power of 2 (1 <= num < 2147483648), as an argparse
-	type.
+	Check if an input is a power of 2, as an argparse type.
 
 	Parameters
 	----------
@@ -106,16 +114,10 @@ def type_power_of_two(num):
 
     """
     n = int(num)
-    x = 2
     assert n > 0
 
-    if n == 1:
+    if power_of_two(n):
         return n
-    else:
-        while x <= n and x < 2147483648:
-            if n == x:
-                return n
-            x *= 2
 
     message = "%d is not a power of two." % n
     raise argparse.ArgumentTypeError(message)
@@ -159,8 +161,8 @@ def get_key_val(fits_file, ext, keyword):
         print("\tERROR: File does not exist: %s" % fits_file)
         exit()
 
-    key_value = hdulist[ext].header[keyword]
-    hdulist.close()
+    with hdulist:
+        key_value = hdulist[ext].header[keyword]
 
     return key_value
 
@@ -204,10 +206,11 @@ def make_1Dlightcurve(time, n_bins, seg_start, seg_end):
 
     lightcurve_1d, t_bin_edges = np.histogram(time, bins=t_bin_seq)
 
-    lightcurve_1d = lightcurve_1d.astype(np.float64)
-    lightcurve_1d /= dt  ## Need /dt to have units of count rate
-    lightcurve_1d = lightcurve_1d.astype(int)  ## 1/dt is an int, so we can make
-                                               ## 'lightcurve_1d' be ints here.
+    ## Need /dt to have units of count rate. The division already gives
+    ## doubles, so no separate conversion of the counts is needed first.
+    ## 1/dt is an int, so we can make 'lightcurve_1d' be ints here.
+    lightcurve_1d = (lightcurve_1d / dt).astype(int)
+
     return lightcurve_1d
 
 
@@ -277,6 +280,7 @@ def fits_out(out_file, in_file, meta_dict, freq, fracrms_power, fracrms_err,
     out_table.meta['NYQUIST'] = meta_dict['nyquist']
     out_table.meta['DF'] = np.mean(meta_dict['df'])
     out_table.meta['ADJUST'] = "%s" % str(meta_dict['adjust_seg'])
+    out_table.meta['WELCH'] = "%s" % str(meta_dict['welch'])
 
     out_table.write(out_file, overwrite=True)
 
@@ -429,17 +433,75 @@ def var_and_rms(power, df):
     return variance, rms
 
 
+################################################################################
+def welch_err_factor(n_bins, n_seg, n_freq=1):
+    """
+    Compute how much larger the error on the averaged power is with Welch's
+    method (Hann-windowed segments overlapping by half, as in 'extracted_in')
+    than it would be if all the powers averaged together were independent.
+
+    Neighbouring segments share half their data, and the Hann window spreads
+    the power at each Fourier frequency into the neighbouring ones, so the
+    powers are correlated. For white noise, the correlation between the powers
+    of segments s bins apart at Fourier frequencies d apart is
+    |sum(w[n] * w[n+s] * exp(-2 pi i d n / n_bins))|^2 / sum(w^2)^2.
+
+    Parameters
+    ----------
+    n_bins : int
+        Number of time bins per segment of light curve.
+
+    n_seg : int
+        The number of segments of data that were averaged together.
+
+    n_freq : int or np.array of ints
+        The number of adjacent Fourier frequencies averaged together, as in
+        re-binning. Default = 1.
+
+    Returns
+    -------
+    err_factor : float or np.array of floats
+        The factor to multiply the error on the power by, for each value of
+        n_freq.
+
+    """
+    window = np.hanning(n_bins)
+    seg_step = n_bins // 2
+    n_freq = np.asarray(n_freq)
+    i_last = n_freq - 1
+    var_factor = 0.0
+
+    ## Only the segment itself and the next one overlap it
+    for i in range(min(n_seg, 2)):
+        lag_window = window[:n_bins - i * seg_step] * window[i * seg_step:]
+        corr = np.square(np.abs(rfft(lag_window, n=n_bins))) / \
+                np.square(np.sum(window ** 2))
+
+        ## Sum of the correlations over d = -(n_freq-1) .. n_freq-1, weighted
+        ## by (1 - |d|/n_freq), the fraction of pairs that are d apart
+        freq_lag = np.arange(len(corr))
+        freq_sum = 2.0 * np.cumsum(corr)[i_last] - corr[0] - \
+                2.0 * np.cumsum(freq_lag * corr)[i_last] / n_freq
+
+        if i == 0:
+            var_factor = var_factor + freq_sum
+        else:
+            var_factor = var_factor + 2.0 * (1.0 - i / float(n_seg)) * freq_sum
+
+    return np.sqrt(var_factor)
+
+
 ################################################################################
 def normalize(power, meta_dict, mean_rate, noisy=True):
     """
-    Generate the Fourier frequencies, remove negative frequencies, normalize
-    the power by Leahy and fractional rms^2 normalizations, and compute the
-    error on the fractional rms^2 power.
+    Generate the non-negative Fourier frequencies, normalize the power by
+    Leahy and fractional rms^2 normalizations, and compute the error on the
+    fractional rms^2 power.
 
     Parameters
     ----------
     power : np.array of floats
-        1-D array of the raw power at each fourier frequency.
+        1-D array of the raw power at each non-negative fourier frequency.
 
     meta_dict : dict
         Control parameters for the data analysis.
@@ -476,32 +538,33 @@ def normalize(power, meta_dict, mean_rate, noisy=True):
 
     """
 
-    ## Compute the FFT sample frequencies (in Hz)
-    freq = fftpack.fftfreq(meta_dict['n_bins'], d=meta_dict['dt'])
+    ## Compute the non-negative FFT sample frequencies (in Hz), up to and
+    ## including the Nyquist frequency. The power was only computed at these
+    ## frequencies, so no slicing is needed.
+    freq = rfftfreq(meta_dict['n_bins'], d=meta_dict['dt'])
 
-    ## Ensure that we're only using and saving the positive frequency
-    ## values (and associated power values)
-    nyq_index = meta_dict['n_bins'] / 2
-    freq = np.abs(freq[0:nyq_index + 1])  ## because it slices at end-1, and we
-        ## want to include 'nyq_index'; abs is because the nyquist freq is both
-        ## pos and neg, and we want it pos here.
-    power = power[0:nyq_index + 1]
+    ## Combine the scalar factors of each normalization first, so that each
+    ## normalized array takes only one pass over the power
+    absrms_norm = 2.0 * meta_dict['dt'] / float(meta_dict['n_bins'])
+    leahy_norm = absrms_norm / mean_rate
+    fracrms_norm = absrms_norm / (mean_rate ** 2)
 
-    ## Compute the error on the mean power
-    err_power = power / np.sqrt(float(meta_dict['n_seg']))
+    ## The error on the mean power is the power / sqrt(number of segments).
+    ## With Welch's method the segments overlap, so they aren't independent.
+    err_norm = 1.0 / np.sqrt(float(meta_dict['n_seg']))
+    if meta_dict['welch']:
+        err_norm *= welch_err_factor(meta_dict['n_bins'], meta_dict['n_seg'])
 
     ## Absolute rms^2 normalization
-    absrms_power = 2.0 * power * meta_dict['dt'] / float(meta_dict['n_bins'])
-    absrms_err = 2.0 * err_power * meta_dict['dt'] / float(meta_dict['n_bins'])
+    absrms_power = power * absrms_norm
 
     ## Leahy normalization
-    leahy_power = absrms_power / mean_rate
-    leahy_err = absrms_err / mean_rate
+    leahy_power = power * leahy_norm
     print("Mean value of Leahy power =", np.mean(leahy_power))  ## ~2
 
     ## Fractional rms^2 normalization
-    fracrms_power = absrms_power / (mean_rate ** 2)
-    fracrms_err = absrms_err / (mean_rate ** 2)
+    fracrms_power = power * fracrms_norm
+    fracrms_err = power * (fracrms_norm * err_norm)
 
     ## Compute the Poisson noise level and subtract it off the power
     if noisy:
@@ -509,9 +572,10 @@ def normalize(power, meta_dict, mean_rate, noisy=True):
         absrms_noise = 2.0 * mean_rate
         leahy_noise = 2.0
 
-        if np.max(freq) > 100:
+        ## freq is in increasing order, so the power above 100 Hz is a slice
+        if freq[-1] > 100:
             print("Mean above 100Hz:", \
-                np.mean(absrms_power[np.where(freq >= 100)]))
+                np.mean(absrms_power[np.searchsorted(freq, 100):]))
             print("Absrms noise:", absrms_noise)
         fracrms_power -= fracrms_noise
         absrms_power -= absrms_noise
@@ -526,37 +590,70 @@ def normalize(power, meta_dict, mean_rate, noisy=True):
 
 
 ################################################################################
-def make_ps(rate):
+def make_ps(rate, window=None):
     """
     Compute the mean count rate, the FFT of the count rate minus the mean, and
-    the power spectrum of this segment of data.
+    the power spectrum of this segment of data. Only the non-negative Fourier
+    frequencies are computed, since the input is real. Many segments can be
+    done in one call by stacking them as the rows of a 2-D array.
+
+    The FFT and power are computed in single precision if the input rate is
+    np.float32, and in double precision otherwise. The mean count rate is
+    always computed in double precision.
 
     Parameters
     ----------
-    rate : np.array of floats
-        1-D array of the count rate of a segment of data.
+    rate : np.array of floats or ints
+        1-D array of the count rate of a segment of data, or 2-D array of
+        shape (n_seg, n_bins) with one segment per row.
+
+    window : np.array of floats
+        1-D array of length n_bins to taper each mean-subtracted segment with
+        before the FFT (e.g. np.hanning), or None for no tapering (a
+        rectangular window). Default = None.
 
     Returns
     -------
     power_segment : np.array of floats
-        1-D array of the power of the segment.
+        1-D array of the power of the segment, at the n_bins/2+1 non-negative
+        Fourier frequencies. 2-D of shape (n_seg, n_bins/2+1) if the input
+        rate was 2-D.
 
-    mean_rate : float
-        The mean count rate of the segment.
+    mean_rate : float or np.array of floats
+        The mean count rate of the segment, or 1-D array of the mean count rate
+        of each segment if the input rate was 2-D.
     """
+    ## Precision to do the FFT in: float32 stays float32, the rest are doubles
+    fft_dtype = np.result_type(rate, np.float32)
+
     ## Compute the mean count rate of the segment
-    mean_rate = np.mean(rate)
+    mean_rate = np.mean(rate, axis=-1, dtype=np.float64)
 
     ## Subtract the mean rate off each value of 'rate'
     ## This eliminates the spike at 0 Hz
-    rate_sub_mean = rate - mean_rate
-
-    ## Take the 1-dimensional FFT of the time-domain photon count rate
-    ## Use the SciPy FFT algorithm, as it's faster than NumPy for large lists
-    fft_data = fftpack.fft(rate_sub_mean)
-
-    ## Compute the power
-    power_segment = np.absolute(fft_data) ** 2
+    rate_sub_mean = rate - np.expand_dims(mean_rate, -1).astype(fft_dtype)
+
+    ## Taper the segment to reduce leakage of power between frequencies
+    ## (in place, which keeps the precision of rate_sub_mean)
+    if window is not None:
+        rate_sub_mean *= window
+
+    ## Take the 1-dimensional FFT of the time-domain photon count rate (along
+    ## each row, if there are many segments)
+    ## The count rate is real, so the negative-frequency half of the FFT is
+    ## redundant; the real-input FFT skips computing it
+    fft_data = rfft(rate_sub_mean, axis=-1, **FFT_KWARGS)
+
+    ## Compute the power as real^2 + imag^2, adding into the same array in
+    ## place, which skips the square root (and the extra array) of taking the
+    ## magnitude first and then squaring it
+    power_segment = np.square(fft_data.real)
+    power_segment += np.square(fft_data.imag)
+
+    ## Correct for the power lost to the window, so that the normalizations
+    ## and the Poisson noise level are the same as without a window
+    if window is not None:
+        power_segment /= np.mean(window ** 2)
 
     return power_segment, mean_rate
 
@@ -564,9 +661,15 @@ def make_ps(rate):
 ################################################################################
 def extracted_in(in_file, meta_dict, print_iterator, test):
     """
-    Open the FITS file light curve (as created in seextrct), read the count rate
-    for a segment, call 'make_ps' to create a power spectrum, add power spectra
-    over all segments.
+    Open the FITS file light curve (as created in seextrct), split the count
+    rate into segments of n_bins, call 'make_ps' on blocks of many segments at
+    once to create their power spectra, add power spectra over all segments.
+
+    If meta_dict['welch'] is True, the segments overlap by half and each is
+    tapered with a Hann window (Welch's method), which gives about twice as
+    many segments to average from the same light curve. Overlapping segments
+    are not fully independent; 'normalize' and the re-binning account for this
+    in the error (see 'welch_err_factor').
 
     Parameters
     ----------
@@ -577,7 +680,8 @@ def extracted_in(in_file, meta_dict, print_iterator, test):
         Control parameters for the data analysis.
 
     print_iterator : int
-        Program prints out which segment we're on every print_iterator segments.
+        Not used here, since progress is printed after each block of segments;
+        kept so the call matches 'fits_in'.
 
     test : bool
         True if only running one segment of data for testing, False if analyzing
@@ -610,78 +714,102 @@ def extracted_in(in_file, meta_dict, print_iterator, test):
     of the input binned light curve.
     """
 
-    ## Open the fits file and load the data
+    ## Open the fits file and get the time and count rate columns. With memmap,
+    ## these are views of the file on disk, and only the parts used are read.
     try:
-        fits_hdu = fits.open(in_file)
+        fits_hdu = fits.open(in_file, memmap=True)
     except IOError:
         print("\tERROR: File does not exist: %s" % in_file)
         exit()
 
-    data = fits_hdu[1].data
-    fits_hdu.close()
+    with fits_hdu:
+        time_col = fits_hdu[1].data.field(0)
+        rate_col = fits_hdu[1].data.field(1)
 
     ## Initializations
     whole_lc = psd_lc.Lightcurve(n_bins=meta_dict['n_bins'])
-    n_seg = 0
-    exposure = 0
-    dt_whole = np.array([])
-    df_whole = np.array([])
-    i = 0  # start of bin index to make segment of data for inner for-loop
-    j = meta_dict['n_bins']  # end of bin index to make segment of data for
-                             # inner for-loop
-
-    ## Loop through segments of the data
-    while j <= len(data.field(1)):  ## while we haven't reached the end of the
-                                    ## file
-
-        n_seg += 1
-        start_time = data.field(0)[i]
-        end_time = data.field(0)[j-1]
-
-        ## Extract the second column of 'data' and assigns it to 'rate'.
-        rate = data[i:j].field(1)
-
-        power_segment, mean_rate_segment = make_ps(rate)
-        assert int(len(power_segment)) == meta_dict['n_bins'], "ERROR: "\
-                    "Something went wrong in make_ps. Length of power spectrum"\
-                    " segment  != n_bins."
-
-        dt_seg = (end_time - start_time) / float(meta_dict['n_bins'])
-        df_seg = 1.0 / (meta_dict['n_bins'] * dt_seg)
-
-        ## Compute variance and rms of the positive-frequency power in the
-        ## reference band. Only keep segments where the variance > 0.
-        absrms_pow = raw_to_absrms(power_segment[0:meta_dict['n_bins']/2+1],
-                mean_rate_segment, meta_dict['n_bins'], dt_seg, noisy=True)
-
-        var, rms = var_and_rms(absrms_pow, df_seg)
-
-        if var >= 0.0:
-            whole_lc.power += power_segment
-            whole_lc.mean_rate += mean_rate_segment
+    n_bins = meta_dict['n_bins']
 
-            exposure += end_time - start_time
-
-            dt_whole = np.append(dt_whole, dt_seg)
-            df_whole = np.append(df_whole, df_seg)
-
-            if n_seg % print_iterator == 0:
-                print("\t", n_seg)
+    if meta_dict['welch']:
+        seg_step = n_bins // 2  ## segments overlap by half
+        window = np.hanning(n_bins)
+    else:
+        seg_step = n_bins
+        window = None
 
-            if (test == True) and (n_seg == 1):  # For testing
-                break
+    if meta_dict['fp32']:
+        fft_dtype = np.float32
+    else:
+        fft_dtype = np.float64
 
-        ## Clear loop variables for the next round
-        rate = None
-        power_segment = None
-        mean_rate_segment = None
+    ## Only whole segments are used
+    n_seg = max(0, (len(rate_col) - n_bins) // seg_step + 1)
+    seg_start = np.arange(n_seg) * seg_step
 
-        ## Increment the counters and indices
-        i = j
-        j += meta_dict['n_bins']
-        ## Since the for-loop goes from i to j-1 (since that's how the range
-        ## function works) it's ok that we set i=j here for the next round.
-        ## This will not cause double-counting rows or skipping rows.
+    ## Stack the segments of the count rate as the rows of a 2-D array (a view,
+    ## not a copy), so that many of their FFTs are taken in one call
+    if n_seg > 0:
+        rate = np.lib.stride_tricks.sliding_window_view(rate_col,
+                n_bins)[::seg_step][0:n_seg]
+    else:
+        rate = np.zeros((0, n_bins), dtype=np.float64)
+    start_time = time_col[seg_start]
+    end_time = time_col[seg_start + n_bins - 1]
+
+    dt_seg = (end_time - start_time) / float(n_bins)
+    df_seg = 1.0 / (n_bins * dt_seg)
+    keep = np.zeros(n_seg, dtype=bool)
+
+    ## Take the FFTs a block of segments at a time, so that the count rates,
+    ## FFTs and power of a block stay small enough to be reused from the CPU
+    ## cache instead of being streamed to and from main memory
+    seg_per_block = max(1, FFT_BLOCK_BYTES // (16 * n_bins))
+
+    for b_start in range(0, n_seg, seg_per_block):
+        b_end = min(b_start + seg_per_block, n_seg)
+
+        ## Only this block of the count rate is read and converted to floats
+        power_segment, mean_rate_segment = make_ps(np.asarray(
+                rate[b_start:b_end], dtype=fft_dtype), window=window)
+        assert np.shape(power_segment) == (b_end - b_start, n_bins // 2 + 1), \
+                "ERROR: Something went wrong in make_ps. Length of power "\
+                "spectrum segments != n_bins/2+1."
+
+        ## Compute variance of the positive-frequency power in the reference
+        ## band for each segment. Only keep segments where the variance > 0.
+        ## This is the sum of the absolute rms^2 power (as in 'raw_to_absrms')
+        ## times df; the per-segment factors are applied to the summed power
+        ## instead of to each frequency.
+        absrms_norm = 2.0 * dt_seg[b_start:b_end] / float(n_bins)
+        absrms_noise = 2.0 * mean_rate_segment * (n_bins // 2 + 1)
+        var = (np.sum(power_segment, axis=1) * absrms_norm - absrms_noise) * \
+                df_seg[b_start:b_end]
+        keep[b_start:b_end] = var >= 0.0
+
+        if test and keep[0]:  # For testing
+            n_seg = 1
+            keep[1:] = False
+            whole_lc.pos_power += power_segment[0]
+            whole_lc.mean_rate += mean_rate_segment[0]
+            break
+
+        whole_lc.pos_power += np.sum(power_segment[keep[b_start:b_end]],
+                axis=0)
+        whole_lc.mean_rate += np.sum(mean_rate_segment[keep[b_start:b_end]])
+
+        print("\t", b_end)
+
+    ## Exposure is the time covered by the union of the kept segments. When
+    ## segments overlap, only count the part of each kept segment that isn't
+    ## already covered by the previous kept segment.
+    kept_start = seg_start[keep]
+    n_overlap = np.zeros(len(kept_start))
+    n_overlap[1:] = np.clip(kept_start[:-1] + n_bins - kept_start[1:], 0,
+            n_bins)
+    exposure = np.sum((end_time[keep] - start_time[keep]) * \
+            (n_bins - n_overlap) / float(n_bins))
+    dt_whole = dt_seg[keep]
+    df_whole = df_seg[keep]
 
     return whole_lc, n_seg, exposure, dt_whole, df_whole
 
@@ -730,11 +858,11 @@ def fits_in(in_file, meta_dict, print_iterator=int(5), test=False,
     exposure : float
         The exposure time of all the data used, in seconds.
 
-    dt_whole : list of floats
+    dt_whole : np.array of floats
         1-D list of the dt for each segment of data. Only different if
         adjust=True.
 
-    df_whole : list of floats
+    df_whole : np.array of floats
         1-D list of the df for each segment of data. Only different if
         adjust=True.
 
@@ -759,11 +887,10 @@ def fits_in(in_file, meta_dict, print_iterator=int(5), test=False,
 
     ## Read in from a normal fits table
     try:
-        fits_hdu = fits.open(in_file)
-        time = fits_hdu[1].data.field('TIME')  ## Data is in ext 1
-        channel = fits_hdu[1].data.field('CHANNEL')
-        pcuid = fits_hdu[1].data.field('PCUID')
-        fits_hdu.close()
+        with fits.open(in_file, memmap=True) as fits_hdu:
+            time = fits_hdu[1].data.field('TIME')  ## Data is in ext 1
+            channel = fits_hdu[1].data.field('CHANNEL')
+            pcuid = fits_hdu[1].data.field('PCUID')
     except IOError:
         print("\tERROR: File does not exist: %s" % in_file)
         exit()
@@ -772,26 +899,39 @@ def fits_in(in_file, meta_dict, print_iterator=int(5), test=False,
     n_seg = 0
     lightcurve = np.array([])
     exposure = 0
-    dt_whole = np.array([])
-    df_whole = np.array([])
 
     start_time = time[0]
     final_time = time[-1]
     end_time = start_time + meta_dict['n_seconds']
 
+    ## Segments don't overlap, so there can't be more of them than fit end to
+    ## end in the observation. Allocate the per-segment arrays for that many
+    ## and trim them at the end, instead of growing them every segment.
+    seg_length = meta_dict['n_seconds'] + \
+            (meta_dict['adjust_seg'] * meta_dict['dt'])
+    max_n_seg = int((final_time - start_time) // seg_length) + 1
+    dt_whole = np.zeros(max_n_seg, dtype=np.float64)
+    df_whole = np.zeros(max_n_seg, dtype=np.float64)
+
+    ## Build one mask for all the filters and apply it to the times once, so
+    ## the columns are only read, not copied, for each filter
+    event_mask = np.ones(len(time), dtype=bool)
+
     ## Filter data based on pcu
     if pcu is not None:
         # print("PCU = %d" % pcu)
-        PCU_mask = pcuid == int(pcu)
-        time = time[PCU_mask]
-        channel = channel[PCU_mask]
+        event_mask &= pcuid == int(pcu)
 
     ## Filter data based on energy channel (event mode binned energy channel)
     if chan_bounds is not None:
-        chan_mask = (channel >= chan_bounds[0]) & (channel <= chan_bounds[1])
-        time = time[chan_mask]
+        event_mask &= (channel >= chan_bounds[0]) & (channel <= chan_bounds[1])
 
-    all_time = np.asarray(time, dtype=np.float64)
+    if pcu is not None or chan_bounds is not None:
+        time = time[event_mask]
+
+    ## Sort once so that each segment is a contiguous slice of the event times
+    all_time = np.sort(np.asarray(time, dtype=np.float64))
+    seg_start_index = 0  # index in all_time of the first event not yet used
 
     #############################
     ## Loop through the segments
@@ -802,38 +942,43 @@ def fits_in(in_file, meta_dict, print_iterator=int(5), test=False,
         ## Adjust segment length to artificially line up the QPOs
         end_time += (meta_dict['adjust_seg'] * meta_dict['dt'])
 
-        time = all_time[np.where(all_time < end_time)]
-        for_next_iteration = np.where(all_time >= end_time)
-        all_time = all_time[for_next_iteration]
+        ## Events before end_time belong to this segment; find the split point
+        ## with a binary search instead of re-filtering all remaining events
+        seg_end_index = np.searchsorted(all_time, end_time, side='left')
+        time = all_time[seg_start_index:seg_end_index]
+        seg_start_index = seg_end_index
 
         if len(time) > 0:
             rate_1d = make_1Dlightcurve(time, meta_dict['n_bins'], \
                     start_time, end_time)
-            lightcurve = np.concatenate((lightcurve, rate_1d))
+            if test:
+                lightcurve = np.concatenate((lightcurve, rate_1d))
+
+            if meta_dict['fp32']:
+                rate_1d = rate_1d.astype(np.float32)
 
             power_segment, mean_rate_segment = make_ps(rate_1d)
-            assert int(len(power_segment)) == meta_dict['n_bins'], "ERROR: "\
-                    "Something went wrong in make_ps. Length of power spectrum"\
-                    " segment != n_bins."
+            assert int(len(power_segment)) == meta_dict['n_bins'] // 2 + 1, \
+                    "ERROR: Something went wrong in make_ps. Length of power "\
+                    "spectrum segment != n_bins/2+1."
 
             dt_seg = (end_time - start_time) / float(meta_dict['n_bins'])
             df_seg = 1.0 / (meta_dict['n_bins'] * dt_seg)
 
             ## Compute variance and rms of the positive-frequency power in the
             ## reference band. Only keep segments where the variance > 0.
-            absrms_pow = raw_to_absrms(power_segment[0:meta_dict['n_bins']/2+1],
-                    mean_rate_segment, meta_dict['n_bins'], dt_seg, noisy=True)
+            absrms_pow = raw_to_absrms(power_segment, mean_rate_segment,
+                    meta_dict['n_bins'], dt_seg, noisy=True)
 
             var, rms = var_and_rms(absrms_pow, df_seg)
 
             if var >= 0.0:
                 n_seg += 1
-                whole_lc.power += power_segment
+                whole_lc.pos_power += power_segment
                 whole_lc.mean_rate += mean_rate_segment
                 exposure += end_time - start_time
-                dt_seg = (end_time - start_time) / float(meta_dict['n_bins'])
-                dt_whole = np.append(dt_whole, dt_seg)
-                df_whole = np.append(df_whole, 1.0 / (meta_dict['n_bins'] * dt_seg))
+                dt_whole[n_seg-1] = dt_seg
+                df_whole[n_seg-1] = df_seg
 
                 ## Print out which segment we're on every x segments
                 if n_seg % print_iterator == 0:
@@ -856,9 +1001,12 @@ def fits_in(in_file, meta_dict, print_iterator=int(5), test=False,
         ## This next bit deals with gappy data
         elif len(time) == 0:
             print("No counts in this segment.")
-            start_time = all_time[0]
+            start_time = all_time[seg_start_index]
             end_time = start_time + meta_dict['n_seconds']
 
+    dt_whole = dt_whole[0:n_seg]
+    df_whole = df_whole[0:n_seg]
+
     return whole_lc, n_seg, exposure, dt_whole, df_whole
 
 
@@ -930,6 +1078,11 @@ def read_and_use_segments(in_file, meta_dict, test=False, chan_bounds=None,
     ## power spectrum can be taken, whereas data from lc was made in seextrct
     ## and so it's already populated as a light curve
     if ".fits" in in_file:
+        if meta_dict['welch']:
+            raise Warning("Not able to use Welch's method for a .fits event "\
+                    "list, since segments are populated one at a time and "\
+                    "can't be overlapped. Make an .lc file first.")
+
         whole_lc, n_seg, exposure, dt_whole, df_whole = fits_in(in_file,
                 meta_dict, print_iterator=print_iterator, test=test,
                 chan_bounds=chan_bounds, pcu=pcu)
@@ -955,7 +1108,7 @@ def read_and_use_segments(in_file, meta_dict, test=False, chan_bounds=None,
 
 ################################################################################
 def main(input_file, out_file, n_seconds, dt_mult, test=False, adjust=False,
-        lo_chan=None, up_chan=None, pcu=None):
+        lo_chan=None, up_chan=None, pcu=None, welch=False, fp32=False):
     """
     Read in one data file at a time, take FFT of segments of light curve data,
     compute power of each segment, average power over all segments of all data
@@ -1000,6 +1153,17 @@ def main(input_file, out_file, n_seconds, dt_mult, test=False, adjust=False,
     pcu : int
         The RXTE PCU to make a power spectrum for. Optional, default = None.
 
+    welch : bool
+        Flag: False for averaging non-overlapping, un-windowed segments, True
+        for Welch's method: Hann-windowed segments, overlapping by half. Only
+        for .lc input. Optional, default = False.
+
+    fp32 : bool
+        Flag: False for computing the segment FFTs and powers in double
+        precision, True for single precision, which is faster and uses half
+        the memory for large n_bins. Mean rates and the averaged power are
+        still accumulated in double precision. Optional, default = False.
+
     Raises
     ------
     assert error if n_seconds <= 0
@@ -1041,17 +1205,23 @@ def main(input_file, out_file, n_seconds, dt_mult, test=False, adjust=False,
     ## Initializations
     ###################
 
+    ## Read the keywords from the headers of the first file, opening it once
     try:
-        t_res = float(get_key_val(data_files[0], 0, 'TIMEDEL'))
-    except KeyError:
-        t_res = float(get_key_val(data_files[0], 1, 'TIMEDEL'))
-
-    try:
-        detchans = int(get_key_val(data_files[0], 0, 'DETCHANS'))
-    except KeyError:
-        detchans = int(get_key_val(data_files[0], 1, 'DETCHANS'))
+        hdulist = fits.open(data_files[0])
     except IOError:
-        detchans = 64
+        print("\tERROR: File does not exist: %s" % data_files[0])
+        exit()
+
+    with hdulist:
+        try:
+            t_res = float(hdulist[0].header['TIMEDEL'])
+        except KeyError:
+            t_res = float(hdulist[1].header['TIMEDEL'])
+
+        try:
+            detchans = int(hdulist[0].header['DETCHANS'])
+        except KeyError:
+            detchans = int(hdulist[1].header['DETCHANS'])
 
     meta_dict = {'dt': dt_mult * t_res,
                  't_res': t_res,
@@ -1059,13 +1229,17 @@ def main(input_file, out_file, n_seconds, dt_mult, test=False, adjust=False,
                  'df': 1.0 / float(n_seconds),
                  'nyquist': 1.0 / (2.0 * dt_mult * t_res),
                  'n_bins': n_seconds * int(1.0 / (dt_mult * t_res)),
-                 'detchans': detchans}
+                 'detchans': detchans,
+                 'welch': welch,
+                 'fp32': fp32}
 
     print("\nDT = %f seconds" % meta_dict['dt'])
     print("N_bins = %d" % meta_dict['n_bins'])
     print("Nyquist freq =", meta_dict['nyquist'])
     print("Testing?", test)
     print("Adjusting QPO?", adjust)
+    print("Welch's method?", welch)
+    print("Single precision FFTs?", fp32)
 
     if lo_chan is not None:
         if up_chan is not None:
@@ -1104,7 +1278,7 @@ def main(input_file, out_file, n_seconds, dt_mult, test=False, adjust=False,
         dt_total = np.append(dt_total, dt_whole)
         df_total = np.append(df_total, df_whole)
 
-        total.power += whole_lc.power
+        total.pos_power += whole_lc.pos_power
         total.mean_rate += whole_lc.mean_rate
 
     ## End of for-loop
@@ -1112,10 +1286,10 @@ def main(input_file, out_file, n_seconds, dt_mult, test=False, adjust=False,
 
     meta_dict['n_seg'] = total_seg
 
-    total.power /= float(meta_dict['n_seg'])
+    total.pos_power /= float(meta_dict['n_seg'])
     total.mean_rate /= float(meta_dict['n_seg'])
 
-    # print(np.shape(total.power))
+    # print(np.shape(total.pos_power))
     meta_dict['exposure'] = total_exposure
     meta_dict['mean_rate'] = total.mean_rate
     meta_dict['dt'] = np.mean(dt_total)
@@ -1128,15 +1302,12 @@ def main(input_file, out_file, n_seconds, dt_mult, test=False, adjust=False,
     ## Normalize the power spectrum and compute error
     ##################################################
 
-    total_variance = np.sum(total.power * meta_dict['df'])
-    rms_total = np.sqrt(total_variance)
-
     freq, power, leahy_power, fracrms_power, fracrms_err, rms = \
-            normalize(total.power, meta_dict, total.mean_rate, True)
+            normalize(total.pos_power, meta_dict, total.mean_rate, True)
 
     meta_dict['rms'] = rms
-    # print(freq[meta_dict['n_bins']/2])
-    meta_dict['nyquist'] = freq[meta_dict['n_bins']/2]
+    ## The last non-negative Fourier frequency is the Nyquist frequency
+    meta_dict['nyquist'] = freq[-1]
     # print(meta_dict['nyquist'])
 
     ##########
@@ -1204,6 +1375,15 @@ if __name__ == "__main__":
             type=int, default=None, help="If present, the RXTE PCU to make a "\
             "power spectrum for. [None]")
 
+    parser.add_argument('-w', '--welch', default=False, action='store_true',
+            dest='welch', help="If present, uses Welch's method: the segments "\
+            "overlap by half and each is tapered with a Hann window. Only for "\
+            ".lc input. [False]")
+
+    parser.add_argument('--fp32', default=False, action='store_true',
+            dest='fp32', help="If present, computes the FFTs and power of the "\
+            "segments in single precision instead of double precision. "\
+            "[False]")
 
     args = parser.parse_args()
 
@@ -1213,6 +1393,7 @@ if __name__ == "__main__":
 
     main(args.infile, args.outfile, args.n_seconds, args.dt_mult,
             test=testing, adjust=args.adjust, lo_chan=args.lo_energy,
-            up_chan=args.up_energy, pcu=args.pcu)
+            up_chan=args.up_energy, pcu=args.pcu, welch=args.welch,
+            fp32=args.fp32)
 
 ################################################################################
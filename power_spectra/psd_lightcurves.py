@@ -14,7 +14,7 @@ class Lightcurve(object):
     def __init__(self, n_bins=8192):
         self.power_array = np.zeros((n_bins, 1), dtype=np.float64)
         self.power = np.zeros(n_bins, dtype=np.float64)
-        self.pos_power = np.zeros(n_bins/2+1, dtype=np.float64)
+        self.pos_power = np.zeros(n_bins//2+1, dtype=np.float64)
         self.mean_rate_array = 0.0
         self.mean_rate = 0.0
         self.var = 0.0   # variance of the absolute-rms-normalized power
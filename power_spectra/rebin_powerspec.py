@@ -15,6 +15,7 @@ from matplotlib.ticker import ScalarFormatter
 from datetime import datetime
 import os.path
 import subprocess
+import powerspec as psd
 
 __author__ = "Abigail Stevens <A.L.Stevens at uva.nl>"
 __year__ = "2013-2016"
@@ -107,6 +108,7 @@ def fits_out(out_file, rb_out_file, meta_dict, mean_rate_whole, rb_freq, \
     out_table.meta['NYQUIST'] = meta_dict['nyquist']
     out_table.meta['DF'] = np.mean(meta_dict['df'])
     out_table.meta['ADJUST'] = meta_dict['adjust_seg']
+    out_table.meta['WELCH'] = "%s" % str(meta_dict['welch'])
 
     out_table.write(rb_out_file, overwrite=True)
 
@@ -122,17 +124,56 @@ def flx2xsp_out(rb_out, freq_min, freq_max, rb_freq, rb_rms2, rb_err):
     out_file = dir+"/"+base+"_flx2xsp.txt"
     print("Table for FLX2XSP:", out_file)
 
-    with open(out_file, 'w') as out:
-        for i in range(len(rb_freq)):
-            delta_nu = freq_max[i] - freq_min[i]
-            pow = rb_rms2[i] * rb_freq[i] * delta_nu
-            err = rb_err[i] * rb_freq[i] * delta_nu
-            out.write("%f \t%f \t%.6e \t%.6e\n" % (freq_min[i], freq_max[i],
-                                                   pow, err))
+    delta_nu = freq_max - freq_min
+    pow = rb_rms2 * rb_freq * delta_nu
+    err = rb_err * rb_freq * delta_nu
+
+    ## Format and write the whole table at once instead of row by row
+    np.savetxt(out_file, np.column_stack((freq_min, freq_max, pow, err)),
+            fmt=["%f", "%f", "%.6e", "%.6e"], delimiter=" \t")
 
 
 ################################################################################
-def geometric_rebinning(freq, power, err_power, rebin_const):
+def geometric_bin_edges(n_freq, rebin_const):
+    """
+    Compute the indices where each geometric bin starts. Each new bin is
+    rebin_const times wider than the previous one, rounded to an int. Only
+    whole bins are kept, so the last edge is the end of the last full bin.
+
+    Parameters
+    ----------
+    n_freq : int
+        The number of un-binned Fourier frequencies.
+
+    rebin_const : float
+        The constant by which the data will be geometrically re-binned.
+
+    Returns
+    -------
+    edges : np.array of ints
+        1-D array of the bin edges, in index space of the un-binned arrays. Bin
+        i covers indices edges[i] to edges[i+1]-1.
+
+    """
+    ## Without re-binning every bin has a width of one, so skip the loop, which
+    ## would otherwise step through every frequency
+    if rebin_const == 1.0:
+        return np.arange(max(n_freq, 1), dtype=np.int64)
+
+    edges = [0]				   # Indices where each new bin starts
+    real_index = 1.0		   # The unrounded width of the next bin
+    current_m = 1			   # Current index in the un-binned arrays
+    while current_m < n_freq:
+        edges.append(current_m)
+        real_index *= rebin_const
+        current_m += int(round(real_index))
+
+    return np.asarray(edges, dtype=np.int64)
+
+
+################################################################################
+def geometric_rebinning(freq, power, err_power, rebin_const, welch=False,
+        n_seg=1):
     """
     Re-bin the power spectrum in frequency space by some re-binning constant
     (rebin_const > 1).
@@ -153,6 +194,16 @@ def geometric_rebinning(freq, power, err_power, rebin_const):
     rebin_const : float
         The constant by which the data were geometrically re-binned.
 
+    welch : bool
+        True if the power spectrum was made with Welch's method. Adjacent
+        Fourier frequencies are then correlated, so the re-binned error is
+        scaled up accordingly (see 'powerspec.welch_err_factor'). Default =
+        False.
+
+    n_seg : int
+        The number of segments averaged together in the power spectrum. Only
+        used if welch is True. Default = 1.
+
     Returns
     -------
     rb_freq : np.array of floats
@@ -174,60 +225,35 @@ def geometric_rebinning(freq, power, err_power, rebin_const):
 
     """
 
-    ## Initialize variables
-    rb_power = np.asarray([])  # List of re-binned power
-    rb_freq = np.asarray([])   # List of re-binned frequencies
-    rb_err = np.asarray([])	   # List of error in re-binned power
-    real_index = 1.0		   # The unrounded next index in power
-    int_index = 1			   # The int of real_index, added to current_m every
-                               #  iteration
-    current_m = 1			   # Current index in power
-    prev_m = 0				   # Previous index m
-    bin_power = 0.0			   # The power of the current re-binned bin
-    bin_freq = 0.0			   # The frequency of the current re-binned bin
-    err_bin_power2 = 0.0	   # The error squared on 'bin_power'
-    bin_range = 0.0			   # The range of un-binned bins covered by this
-                               #  re-binned bin
-    freq_min = np.asarray([])
-    freq_max = np.asarray([])
-
-    ## Loop through the length of the array power, new bin by new bin, to
-    ## compute the average power and frequency of that new geometric bin.
+    freq = np.asarray(freq, dtype=np.float64)
+    power = np.asarray(power, dtype=np.float64)
+    err_power = np.asarray(err_power, dtype=np.float64)
+
+    ## Determine the edges (in index space) of the geometric bins
+    edges = geometric_bin_edges(len(power), rebin_const)
+
+    ## The range of un-binned bins covered by each re-binned bin
+    bin_range = np.diff(edges).astype(np.float64)
+
+    ## Sum the un-binned values within each geometric bin in one call. Power
+    ## past the last full bin is not used, so cut it off before reducing.
     ## Equations for frequency, power, and error are from A. Ingram's PhD thesis
-    while current_m < len(power):
-# 	while current_m < 100: # used for debugging
-
-        ## Determine the range of indices this specific geometric bin covers
-        bin_range = np.absolute(current_m - prev_m)
-        ## Want mean power of data points contained within one geometric bin
-        bin_power = np.mean(power[prev_m:current_m])
-        ## Compute error in bin -- equation from Adam Ingram's thesis
-        err_bin_power2 = np.sqrt(np.sum(err_power[prev_m:current_m] ** 2)) / \
-            float(bin_range)
-
-        ## Compute the mean frequency of a geometric bin
-        bin_freq = np.mean(freq[prev_m:current_m])
-
-        ## Append values to arrays
-        rb_power = np.append(rb_power, bin_power)
-        rb_freq = np.append(rb_freq, bin_freq)
-        rb_err = np.append(rb_err, err_bin_power2)
-        freq_min = np.append(freq_min, freq[prev_m])
-        freq_max = np.append(freq_max, freq[current_m])
-
-        ## Increment for the next iteration of the loop
-        ## Since the for-loop goes from prev_m to current_m-1 (since that's how
-        ## the range function and array slicing works) it's ok that we set
-        ## prev_m = current_m here for the next round. This will not cause any
-        ## double-counting bins or skipping bins.
-        prev_m = current_m
-        real_index *= rebin_const
-        int_index = int(round(real_index))
-        current_m += int_index
-        bin_range = None
-        bin_freq = None
-        bin_power = None
-        err_bin_power2 = None
+    rb_power = np.add.reduceat(power[:edges[-1]], edges[:-1]) / bin_range
+    rb_freq = np.add.reduceat(freq[:edges[-1]], edges[:-1]) / bin_range
+    ## Errors add in quadrature; each error is squared once, up front
+    err_power2 = np.square(err_power[:edges[-1]])
+    rb_err = np.sqrt(np.add.reduceat(err_power2, edges[:-1])) / bin_range
+
+    ## Adding in quadrature assumes independent powers, which they aren't with
+    ## Welch's method. The input error already includes the factor for one
+    ## Fourier frequency, so only scale by the extra from averaging over more.
+    if welch:
+        n_bins = 2 * (len(power) - 1)
+        rb_err *= psd.welch_err_factor(n_bins, n_seg, np.diff(edges)) / \
+                psd.welch_err_factor(n_bins, n_seg)
+
+    freq_min = freq[edges[:-1]]
+    freq_max = freq[edges[1:]]
 
     return rb_freq, rb_power, rb_err, freq_min, freq_max
 
@@ -374,6 +400,7 @@ if __name__ == "__main__":
                      'n_seconds': in_table.meta['SEC_SEG'],
                      'nyquist': in_table.meta['NYQUIST'],
                      'rebin_const' : args.rebin_const,
+                     'welch': False,
                      'df': in_table.meta['DF']}
         # rate_ci = np.asarray(in_table.meta['RATE_CI'].replace('[',\
         #         '').replace(']','').split(','), dtype=np.float64)
@@ -423,6 +450,7 @@ if __name__ == "__main__":
                      'df': in_table.meta['DF'],
                      'adjust_seg': in_table.meta['ADJUST'],
                      'rms': in_table.meta['RMS'],
+                     'welch': in_table.meta.get('WELCH', "False") == "True",
                      'n_seconds': in_table.meta['SEC_SEG']}
 
         mean_rate_whole = in_table.meta['MEANRATE']
@@ -433,7 +461,8 @@ if __name__ == "__main__":
     ################################################
 
     rb_freq, rb_rms2, rb_err, freq_min, freq_max = geometric_rebinning(freq,
-            rms2, error, meta_dict['rebin_const'])
+            rms2, error, meta_dict['rebin_const'], welch=meta_dict['welch'],
+            n_seg=meta_dict['n_seg'])
 
     ########################################
     ## Want to plot nu * P(nu) in log space
@@ -0,0 +1,56 @@
+import os
+import sys
+import numpy as np
+import pytest
+from astropy.table import Table
+
+## powerspec.py is run as a script and imports its neighbours by module name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import powerspec
+
+
+def make_lc_file(lc_file, n_bins, n_seg, dt=1.0/128.0):
+    """
+    Write a strongly variable light curve (so that no segment is rejected) with
+    a few bins past the last whole segment, in the format of a seextrct .lc.
+    """
+    rng = np.random.RandomState(1)
+    n = n_bins * n_seg + 17
+    time = np.arange(n) * dt
+    mean_rate = 1000.0 * (1.0 + 0.5 * np.sin(2.0 * np.pi * 3.0 * time))
+    rate = rng.poisson(mean_rate * dt) / dt
+    Table([time, rate], names=['TIME', 'RATE']).write(lc_file, format='fits',
+            overwrite=True)
+
+
+def test_welch_exposure(tmpdir):
+    lc_file = str(tmpdir.join('test.lc'))
+    make_lc_file(lc_file, 1024, 12)
+
+    exposure = {}
+    for welch in (False, True):
+        meta_dict = {'n_bins': 1024, 'welch': welch, 'fp32': False}
+        whole_lc, n_seg, exposure[welch], dt_whole, df_whole = \
+                powerspec.extracted_in(lc_file, meta_dict, 5, False)
+        assert len(dt_whole) == n_seg
+
+    assert np.isclose(exposure[True], exposure[False])
+
+
+def test_welch_refused_for_event_list():
+    meta_dict = {'n_bins': 1024, 'welch': True, 'fp32': False}
+    with pytest.raises(Warning):
+        powerspec.read_and_use_segments('events.fits', meta_dict)
+
+
+def test_welch_err_factor():
+    ## For one Hann-windowed segment, the powers at adjacent Fourier
+    ## frequencies have a correlation of about 4/9, and 1/36 two apart
+    n_freq = np.array([1, 2, 32])
+    expected = np.sqrt(1.0 + 2.0 * ((n_freq - 1.0) / n_freq * 4.0 / 9.0 + \
+            np.clip(n_freq - 2.0, 0, None) / n_freq / 36.0))
+    assert np.allclose(powerspec.welch_err_factor(1024, 1, n_freq), expected,
+            rtol=1e-3)
+
+    ## Half-overlapping segments add to the error on each power
+    assert powerspec.welch_err_factor(1024, 40) > 1.0